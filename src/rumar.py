@@ -24,13 +24,17 @@ import stat
 import sys
 import tarfile
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta, date
 from enum import Enum
+from functools import lru_cache, cached_property
 from hashlib import blake2b
 from io import BufferedIOBase
 from os import PathLike
-from pathlib import Path
+from pathlib import Path, PurePath
 from textwrap import dedent
 from typing import Iterator, Union, Optional, Literal, Pattern, Any, Iterable, cast
 
@@ -42,6 +46,16 @@ try:
 except ImportError:
     pass
 
+try:
+    import zstandard
+except ImportError:
+    pass
+
+try:
+    import xxhash
+except ImportError:
+    pass
+
 try:
     import tomllib
 except ImportError:
@@ -261,16 +275,28 @@ class RumarFormat(Enum):
     TGZ = 'tar.gz'
     TBZ = 'tar.bz2'
     TXZ = 'tar.xz'
+    # tar.zst requires zstandard
+    TZST = 'tar.zst'
     # zipx is experimental
     ZIPX = 'zipx'
 
 
+class ChecksumAlgorithm(Enum):
+    BLAKE2B = 'blake2b'
+    # xxh3 requires xxhash
+    XXH3 = 'xxh3'
+
+
 class Command(Enum):
     CREATE = 'create'
     EXTRACT = 'extract'
     SWEEP = 'sweep'
 
 
+# the globs mapped to their regexes, the regexes combined, and the largest number of segments in a glob
+CompiledGlobs = tuple[dict[str, Optional[Pattern]], Optional[Pattern], int]
+
+
 @dataclass
 class Settings:
     r"""
@@ -283,12 +309,14 @@ class Settings:
     backup_base_dir_for_profile: str
       used by: create, sweep
       path to the base dir used for the profile; usually left unset; see _**backup_base_dir**_
-    archive_format: Literal['tar', 'tar.gz', 'tar.bz2', 'tar.xz'] = 'tar.gz'
+    archive_format: Literal['tar', 'tar.gz', 'tar.bz2', 'tar.xz', 'tar.zst'] = 'tar.gz'
       used by: create, sweep
       format of archive files to be created
+      'tar.zst' requires the package zstandard
     compression_level: int = 3
       used by: create
       for the formats 'tar.gz', 'tar.bz2', 'tar.xz': compression level from 0 to 9
+      for the format 'tar.zst': compression level from 1 to 22
     no_compression_suffixes_default: str = '7z,zip,zipx,jar,rar,tgz,gz,tbz,bz2,xz,zst,zstd,xlsx,docx,pptx,ods,odt,odp,odg,odb,epub,mobi,png,jpg,gif,mp4,mov,avi,mp3,m4a,aac,ogg,ogv,kdbx'
       used by: create
       comma-separated string of lower-case suffixes for which to use uncompressed tar
@@ -346,13 +374,25 @@ class Settings:
     checksum_comparison_if_same_size: bool = False
       used by: create
       when False, a file is considered changed if its mtime is later than the latest backup's mtime and its size changed
-      when True, BLAKE2b checksum is calculated to determine if the file changed despite having the same size
+      when True, a checksum (see _**checksum_algorithm**_) is calculated to determine if the file changed despite having the same size
       _mtime := time of last modification_
       see also https://en.wikipedia.org/wiki/File_verification
+    checksum_algorithm: Literal['blake2b', 'xxh3'] = 'blake2b'
+      used by: create
+      algorithm used by _**checksum_comparison_if_same_size**_
+      'xxh3' (128-bit XXH3, not cryptographic but good enough to detect a change) is much faster than 'blake2b'
+      'xxh3' requires the package xxhash
+      checksums are saved in files with a suffix specific to the algorithm (.b2, .xxh3), i.e. after a change of the algorithm they're calculated anew
     file_deduplication: bool = False
       used by: create
       when True, an attempt is made to find and skip duplicates
       a duplicate file has the same suffix and size and part of its name, case-insensitive (suffix, name)
+    max_workers_for_create: int = 1
+      used by: create
+      number of files to be archived concurrently, in separate threads
+      1 means one file at a time, in order, stopping at the first error
+      with more than 1, log lines of different files are interleaved, and after an error,
+      the files already being archived are finished before the error stops the run
     min_age_in_days_of_backups_to_sweep: int = 2
       used by: sweep
       only the backups which are older than the specified number of days are considered for removal
@@ -376,7 +416,7 @@ class Settings:
       determines which commands can use the filters specified in the included_* and excluded_* settings
       by default, filters are used only by _**create**_, i.e. _**sweep**_ considers all created backups (no filter is applied)
       a filter for _**sweep**_ could be used to e.g. never remove backups from the first day of a month:
-      `excluded_files_as_regex = ['/\d\d\d\d-\d\d-01_\d\d,\d\d,\d\d\.\d{6}(\+|-)\d\d,\d\d\~\d+(~.+)?.tar(\.(gz|bz2|xz))?$']`
+      `excluded_files_as_regex = ['/\d\d\d\d-\d\d-01_\d\d,\d\d,\d\d\.\d{6}(\+|-)\d\d,\d\d\~\d+(~.+)?.tar(\.(gz|bz2|xz|zst))?$']`
       it's best when the setting is part of a separate profile, i.e. a copy made for _**sweep**_,
       otherwise _**create**_ will also seek such files to be excluded
     """
@@ -405,7 +445,9 @@ class Settings:
     no_compression_suffixes: str = ''
     tar_format: Literal[0, 1, 2] = tarfile.GNU_FORMAT
     checksum_comparison_if_same_size: bool = False
+    checksum_algorithm: Union[ChecksumAlgorithm, str] = ChecksumAlgorithm.BLAKE2B
     file_deduplication: bool = False
+    max_workers_for_create: int = 1
     min_age_in_days_of_backups_to_sweep: int = 2
     number_of_backups_per_day_to_keep: int = 2
     number_of_backups_per_week_to_keep: int = 14
@@ -432,11 +474,12 @@ class Settings:
         self._patternify('included_files_as_regex')
         self._patternify('excluded_dirs_as_regex')
         self._patternify('excluded_files_as_regex')
-        self.suffixes_without_compression = {f".{s}" for s in self.COMMA.join([self.no_compression_suffixes_default, self.no_compression_suffixes]).split(self.COMMA) if s}
+        self.suffixes_without_compression = frozenset(f".{s}" for s in self.COMMA.join([self.no_compression_suffixes_default, self.no_compression_suffixes]).split(self.COMMA) if s)
         # https://stackoverflow.com/questions/71846054/-cast-a-string-to-an-enum-during-instantiation-of-a-dataclass-
         if self.archive_format is None:
             self.archive_format = RumarFormat.TGZ
         self.archive_format = RumarFormat(self.archive_format)
+        self.checksum_algorithm = ChecksumAlgorithm(self.checksum_algorithm)
         self.commands_which_use_filters = tuple(Command(cmd) for cmd in self.commands_which_use_filters)
         try:  # make sure password is bytes
             self.password = self.password.encode(UTF8)
@@ -482,6 +525,31 @@ class Settings:
             raise AttributeError(f"expected a list of values, got {attr!r}")
         setattr(self, attribute_name, [re.compile(elem) for elem in attr])
 
+    @cached_property
+    def included_top_dirs_psx(self) -> list[str]:
+        return [p.as_posix() for p in self.included_top_dirs]
+
+    @cached_property
+    def excluded_top_dirs_psx(self) -> list[str]:
+        return [p.as_posix() for p in self.excluded_top_dirs]
+
+    @cached_property
+    def included_file_dirnames_as_glob(self) -> set[str]:
+        # remove the file part by splitting at the rightmost sep, making sure not to split at the root sep
+        return {f.rsplit(sep, 1)[0] for f in self.included_files_as_glob if (sep := find_sep(f)) and sep in f.lstrip(sep)}
+
+    @cached_property
+    def included_file_dirnames_as_glob_rx(self) -> CompiledGlobs:
+        return compile_globs(self.included_file_dirnames_as_glob)
+
+    @cached_property
+    def included_files_as_glob_rx(self) -> CompiledGlobs:
+        return compile_globs(self.included_files_as_glob)
+
+    @cached_property
+    def excluded_files_as_glob_rx(self) -> CompiledGlobs:
+        return compile_globs(self.excluded_files_as_glob)
+
     def __str__(self):
         return ("{"
                 f"profile: {self.profile!r}, "
@@ -540,14 +608,39 @@ SLASH = '/'
 BACKSLASH = '\\'
 
 
+def walk_with_symlinks_as_files(top_path: Path) -> Iterator[tuple[str, list[str], list[str]]]:
+    """Like os.walk (top-down), but a symlink to a dir is listed among files, as a symlink is a file, not a dir.
+    Uses the file type from os.scandir, so no extra lstat per dir is needed to detect a symlink.
+    Like with os.walk, dirs can be removed from the list to skip them.
+    """
+    stack = [os.fspath(top_path)]
+    while stack:
+        root = stack.pop()
+        dirs = []
+        symlinks_to_dirs = []
+        files = []
+        try:
+            with os.scandir(root) as dir_entries:
+                for dir_entry in dir_entries:
+                    try:
+                        is_dir = dir_entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if not is_dir:
+                        files.append(dir_entry.name)
+                    elif dir_entry.is_symlink():
+                        symlinks_to_dirs.append(dir_entry.name)
+                    else:
+                        dirs.append(dir_entry.name)
+        except OSError:  # like os.walk, skip a dir which cannot be listed
+            continue
+        symlinks_to_dirs.reverse()
+        yield root, dirs, symlinks_to_dirs + files
+        stack.extend(os.path.join(root, d) for d in reversed(dirs))
+
+
 def iter_all_files(top_path: Path):
-    for root, dirs, files in os.walk(top_path):
-        for d in dirs.copy():
-            dir_path = Path(root, d)
-            # a symlink is a file, not a dir
-            if dir_path.is_symlink():
-                dirs.remove(d)
-                files.insert(0, d)
+    for root, dirs, files in walk_with_symlinks_as_files(top_path):
         for file in files:
             yield Path(root, file)
 
@@ -557,65 +650,71 @@ def iter_matching_files(top_path: Path, s: Settings):
     exc_dirs_rx = s.excluded_dirs_as_regex
     inc_files_rx = s.included_files_as_regex
     exc_files_rx = s.excluded_files_as_regex
-    dir_paths__skip_files = []
-    for root, dirs, files in os.walk(top_path):
+    inc_dirs_any_rx = compile_any_of_patterns(inc_dirs_rx)
+    exc_dirs_any_rx = compile_any_of_patterns(exc_dirs_rx)
+    inc_files_any_rx = compile_any_of_patterns(inc_files_rx)
+    exc_files_any_rx = compile_any_of_patterns(exc_files_rx)
+    roots__skip_files = set()
+    top_path_psx = top_path.as_posix()
+    for root, dirs, files in walk_with_symlinks_as_files(top_path):
+        # paths are matched as posix strings, built from root's posix form, and a Path is created only for a file to be yielded
+        root_psx = Path(root).as_posix()
+        root_psx_with_slash = root_psx if root_psx.endswith(SLASH) else root_psx + SLASH
         for d in dirs.copy():
-            dir_path = Path(root, d)
-            # a symlink is a file, not a dir
-            if dir_path.is_symlink():
-                dirs.remove(d)
-                files.insert(0, d)
-                continue
-            relative_dir_p = make_relative_p(dir_path, top_path, with_leading_slash=True)
-            is_dir_matching_top_dirs, skip_files = calc_dir_matches_top_dirs(dir_path, relative_dir_p, s)
+            dir_path_psx = root_psx_with_slash + d
+            relative_dir_p = dir_path_psx.removeprefix(top_path_psx)
+            is_dir_matching_top_dirs, skip_files = calc_dir_matches_top_dirs(dir_path_psx, relative_dir_p, s)
             if skip_files:
-                dir_paths__skip_files.append(dir_path)
+                roots__skip_files.add(os.path.join(root, d))  # as the root yielded for the dir
             if is_dir_matching_top_dirs:  # matches dirnames and/or top_dirs, now check regex
                 if inc_dirs_rx:  # only included paths must be considered
-                    if not find_matching_pattern(relative_dir_p, inc_dirs_rx):
+                    if not find_matching_pattern(relative_dir_p, inc_dirs_rx, inc_dirs_any_rx):
                         dirs.remove(d)
-                        logger.log(DEBUG_13, f"|d ...{relative_dir_p}  -- skipping dir (none of included_dirs_as_regex matches)")
-                if d in dirs and (exc_rx := find_matching_pattern(relative_dir_p, exc_dirs_rx)):
+                        if logger.isEnabledFor(DEBUG_13):
+                            logger.log(DEBUG_13, f"|d ...{relative_dir_p}  -- skipping dir (none of included_dirs_as_regex matches)")
+                if d in dirs and (exc_rx := find_matching_pattern(relative_dir_p, exc_dirs_rx, exc_dirs_any_rx)):
                     dirs.remove(d)
-                    logger.log(DEBUG_14, f"|d ...{relative_dir_p}  -- skipping dir (matches '{exc_rx}')")
+                    if logger.isEnabledFor(DEBUG_14):
+                        logger.log(DEBUG_14, f"|d ...{relative_dir_p}  -- skipping dir (matches '{exc_rx}')")
             else:  # doesn't match dirnames and/or top_dirs
                 dirs.remove(d)
+        if root in roots__skip_files:
+            continue
         for f in files:
-            file_path = Path(root, f)
-            if (dir_path := file_path.parent) in dir_paths__skip_files:
-                continue
-            relative_file_p = make_relative_p(file_path, top_path, with_leading_slash=True)
-            if is_file_matching_glob(file_path, relative_file_p, s):  # matches glob, now check regex
+            file_path_psx = root_psx_with_slash + f
+            relative_file_p = file_path_psx.removeprefix(top_path_psx)
+            if is_file_matching_glob(file_path_psx, relative_file_p, s):  # matches glob, now check regex
                 if inc_files_rx:  # only included paths must be considered
-                    if not find_matching_pattern(relative_file_p, inc_files_rx):
-                        logger.log(DEBUG_13, f"|f ...{relative_file_p}  -- skipping (none of included_files_as_regex matches)")
+                    if not find_matching_pattern(relative_file_p, inc_files_rx, inc_files_any_rx):
+                        if logger.isEnabledFor(DEBUG_13):
+                            logger.log(DEBUG_13, f"|f ...{relative_file_p}  -- skipping (none of included_files_as_regex matches)")
                 else:  # no incl filtering; checking exc_files_rx
-                    if exc_rx := find_matching_pattern(relative_file_p, exc_files_rx):
-                        logger.log(DEBUG_14, f"|f ...{relative_file_p}  -- skipping (matches '{exc_rx}')")
+                    if exc_rx := find_matching_pattern(relative_file_p, exc_files_rx, exc_files_any_rx):
+                        if logger.isEnabledFor(DEBUG_14):
+                            logger.log(DEBUG_14, f"|f ...{relative_file_p}  -- skipping (matches '{exc_rx}')")
                     else:
-                        yield file_path
+                        yield Path(root, f)
             else:  # doesn't match glob
                 pass
 
 
-def calc_dir_matches_top_dirs(dir_path: Path, relative_dir_p: str, s: Settings) -> tuple[bool, bool]:
+def calc_dir_matches_top_dirs(dir_path_psx: str, relative_dir_p: str, s: Settings) -> tuple[bool, bool]:
     """It's used for os.walk() to decide whether to remove dir_path from the list before files are processed in each (remaining) dir_path"""
-    # remove the file part by splitting at the rightmost sep, making sure not to split at the root sep
-    inc_file_dirnames_as_glob = {f.rsplit(sep, 1)[0] for f in s.included_files_as_glob if (sep := find_sep(f)) and sep in f.lstrip(sep)}
-    inc_top_dirs_psx = [p.as_posix() for p in s.included_top_dirs]
-    exc_top_dirs_psx = [p.as_posix() for p in s.excluded_top_dirs]
-    dir_path_psx = dir_path.as_posix()
+    inc_top_dirs_psx = s.included_top_dirs_psx
+    exc_top_dirs_psx = s.excluded_top_dirs_psx
     for exc_top_psx in exc_top_dirs_psx:
         if dir_path_psx.startswith(exc_top_psx):
-            logger.log(DEBUG_14, f"|D ...{relative_dir_p}  -- skipping (matches excluded_top_dirs)")
+            if logger.isEnabledFor(DEBUG_14):
+                logger.log(DEBUG_14, f"|D ...{relative_dir_p}  -- skipping (matches excluded_top_dirs)")
             return False, False
     if not (s.included_top_dirs or s.included_files_as_glob):
-        logger.log(DEBUG_11, f"=D ...{relative_dir_p}  -- including all (no included_top_dirs or included_files_as_glob)")
+        if logger.isEnabledFor(DEBUG_11):
+            logger.log(DEBUG_11, f"=D ...{relative_dir_p}  -- including all (no included_top_dirs or included_files_as_glob)")
         return True, False
-    for dirname_glob in inc_file_dirnames_as_glob:
-        if dir_path.match(dirname_glob):
+    if find_matching_glob(dir_path_psx, s.included_file_dirnames_as_glob_rx):
+        if logger.isEnabledFor(DEBUG_12):
             logger.log(DEBUG_12, f"=D ...{relative_dir_p}  -- matches included_file_as_glob's dirname")
-            return True, False
+        return True, False
     for inc_top_psx in inc_top_dirs_psx:
         # Example
         # source_dir = '/home'
@@ -623,7 +722,8 @@ def calc_dir_matches_top_dirs(dir_path: Path, relative_dir_p: str, s: Settings)
         if dir_path_psx.startswith(inc_top_psx):
             # current dir_path_psx = '/home/docs/med'
             # '/home/docs/med'.startswith('/home/docs')
-            logger.log(DEBUG_12, f"=D ...{relative_dir_p}  -- matches included_top_dirs")
+            if logger.isEnabledFor(DEBUG_12):
+                logger.log(DEBUG_12, f"=D ...{relative_dir_p}  -- matches included_top_dirs")
             return True, False
         if inc_top_psx.startswith(dir_path_psx):
             # current dir_path_psx = '/home'
@@ -632,36 +732,32 @@ def calc_dir_matches_top_dirs(dir_path: Path, relative_dir_p: str, s: Settings)
             # but not for files, i.e. files in '/home' must be skipped
             # no logging - dir_path is included for technical reasons only
             return True, True  # skip_files
-    logger.log(DEBUG_13, f"|D ...{relative_dir_p}  -- skipping (doesn't match dirnames and/or top_dirs)")
+    if logger.isEnabledFor(DEBUG_13):
+        logger.log(DEBUG_13, f"|D ...{relative_dir_p}  -- skipping (doesn't match dirnames and/or top_dirs)")
     return False, False
 
 
-def is_file_matching_glob(file_path: Path, relative_p: str, s: Settings) -> bool:
-    inc_top_dirs_psx = [p.as_posix() for p in s.included_top_dirs]
-    inc_files = s.included_files_as_glob
-    exc_files = s.excluded_files_as_glob
-    file_path_psx = file_path.as_posix()
-    # interestingly, the following expression doesn't have the same effect as the below for-loops - why?
-    # not any(file_path.match(file_as_glob) for file_as_glob in exc_files) and (
-    #         any(file_path.match(file_as_glob) for file_as_glob in inc_files)
-    #         or any(file_path_psx.startswith(top_dir) for top_dir in inc_top_dirs_psx)
-    # )
-    for file_as_glob in exc_files:
-        if file_path.match(file_as_glob):
+def is_file_matching_glob(file_path_psx: str, relative_p: str, s: Settings) -> bool:
+    inc_top_dirs_psx = s.included_top_dirs_psx
+    if file_as_glob := find_matching_glob(file_path_psx, s.excluded_files_as_glob_rx):
+        if logger.isEnabledFor(DEBUG_14):
             logger.log(DEBUG_14, f"|F ...{relative_p}  -- skipping (matches excluded_files_as_glob {file_as_glob!r})")
-            return False
+        return False
     if not (s.included_top_dirs or s.included_files_as_glob):
-        logger.log(DEBUG_11, f"=F ...{relative_p}  -- including all (no included_top_dirs or included_files_as_glob)")
+        if logger.isEnabledFor(DEBUG_11):
+            logger.log(DEBUG_11, f"=F ...{relative_p}  -- including all (no included_top_dirs or included_files_as_glob)")
         return True
-    for file_as_glob in inc_files:
-        if file_path.match(file_as_glob):
+    if file_as_glob := find_matching_glob(file_path_psx, s.included_files_as_glob_rx):
+        if logger.isEnabledFor(DEBUG_12):
             logger.log(DEBUG_12, f"=F ...{relative_p}  -- matches included_files_as_glob {file_as_glob!r}")
-            return True
+        return True
     for inc_top_psx in inc_top_dirs_psx:
         if file_path_psx.startswith(inc_top_psx):
-            logger.log(DEBUG_12, f"=F ...{relative_p}  -- matches included_top_dirs {inc_top_psx!r}")
+            if logger.isEnabledFor(DEBUG_12):
+                logger.log(DEBUG_12, f"=F ...{relative_p}  -- matches included_top_dirs {inc_top_psx!r}")
             return True
-    logger.log(DEBUG_13, f"|F ...{relative_p}  -- skipping file (doesn't match top dir or file glob)")
+    if logger.isEnabledFor(DEBUG_13):
+        logger.log(DEBUG_13, f"|F ...{relative_p}  -- skipping file (doesn't match top dir or file glob)")
     return False
 
 
@@ -682,18 +778,172 @@ def find_sep(g: str) -> str:
     return sep
 
 
-def make_relative_p(path: Path, base_dir: Path, with_leading_slash=False) -> str:
-    relative_p = path.as_posix().removeprefix(base_dir.as_posix())
+def make_relative_p(path: Path, base_dir: Union[Path, str], with_leading_slash=False) -> str:
+    """base_dir can be given as a posix str, to avoid converting it for each path in a loop"""
+    base_dir_psx = base_dir if isinstance(base_dir, str) else base_dir.as_posix()
+    relative_p = path.as_posix().removeprefix(base_dir_psx)
     return relative_p.removeprefix(SLASH) if not with_leading_slash else relative_p
 
 
-def find_matching_pattern(relative_p: str, patterns: list[Pattern]):
+def find_matching_pattern(relative_p: str, patterns: list[Pattern], any_of_patterns: Optional[Pattern] = None):
+    """any_of_patterns, if present, is first used to rule out a path which doesn't match any pattern, with a single search"""
     # logger.debug(f"{relative_p}, {[p.pattern for p in patterns]}")
+    if any_of_patterns and not any_of_patterns.search(relative_p):
+        return None
     for rx in patterns:
         if rx.search(relative_p):
             return rx.pattern
 
 
+RX_LEADING_GLOBAL_FLAGS = re.compile(r'(?:\(\?[aiLmsux]+\))+')
+RX_GLOBAL_FLAGS = re.compile(r'\(\?([aiLmsux]+)\)')
+RX_NUMBERED_GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?\([1-9]')
+
+
+def compile_any_of_patterns(patterns: list[Pattern]) -> Optional[Pattern]:
+    """Combine the patterns into an alternation, which matches if any of the patterns matches.
+    Leading global flags, e.g. (?i), are turned into flags scoped to the pattern's alternative.
+    Return None if there's nothing to gain or the patterns cannot be combined safely, i.e. when a pattern
+    refers to a group by number (numbers would be shifted), uses the verbose flag, or has a global flag elsewhere
+    """
+    if len(patterns) < 2:
+        return None
+    alternatives = []
+    for rx in patterns:
+        pattern = rx.pattern
+        flags = ''
+        if m := RX_LEADING_GLOBAL_FLAGS.match(pattern):
+            flags = ''.join(RX_GLOBAL_FLAGS.findall(m.group()))
+            pattern = pattern[m.end():]
+        if 'x' in flags or RX_GLOBAL_FLAGS.search(pattern) or RX_NUMBERED_GROUP_REFERENCE.search(pattern):
+            return None
+        alternatives.append(f"(?{flags}:{pattern})")
+    try:
+        return re.compile('|'.join(alternatives))
+    except re.error:  # e.g. the same group name used in two patterns
+        return None
+
+
+GLOB_FLAGS = '(?i)' if os.name == 'nt' else ''  # like Path.match(), which ignores case on NT
+
+
+def translate_glob_segment(segment: str) -> str:
+    """Like fnmatch.translate, but for one segment of a path, i.e. a wildcard doesn't match a slash"""
+    res = []
+    i, n = 0, len(segment)
+    while i < n:
+        c = segment[i]
+        i += 1
+        if c == '*':
+            if not res or res[-1] != '[^/]*':  # compress consecutive '*' into one
+                res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and segment[j] == '!':
+                j += 1
+            if j < n and segment[j] == ']':
+                j += 1
+            while j < n and segment[j] != ']':
+                j += 1
+            if j >= n:
+                res.append('\\[')
+            else:
+                stuff = segment[i:j]
+                if '-' not in stuff:
+                    stuff = stuff.replace('\\', r'\\')
+                else:
+                    chunks = []
+                    k = i + 2 if segment[i] == '!' else i + 1
+                    while True:
+                        k = segment.find('-', k, j)
+                        if k < 0:
+                            break
+                        chunks.append(segment[i:k])
+                        i = k + 1
+                        k = k + 3
+                    chunk = segment[i:j]
+                    if chunk:
+                        chunks.append(chunk)
+                    else:
+                        chunks[-1] += '-'
+                    # remove empty ranges - invalid in a regex
+                    for k in range(len(chunks) - 1, 0, -1):
+                        if chunks[k - 1][-1] > chunks[k][0]:
+                            chunks[k - 1] = chunks[k - 1][:-1] + chunks[k][1:]
+                            del chunks[k]
+                    # escape backslashes and hyphens for set difference (--)
+                    stuff = '-'.join(s.replace('\\', r'\\').replace('-', r'\-') for s in chunks)
+                # escape set operations (&&, ~~ and ||)
+                stuff = re.sub(r'([&~|])', r'\\\1', stuff)
+                i = j + 1
+                if not stuff:  # empty range: never match
+                    res.append('(?!)')
+                elif stuff == '!':  # negated empty range: match any character
+                    res.append('[^/]')
+                elif stuff[0] == '!':
+                    res.append(f"[^{stuff[1:]}/]")
+                else:
+                    if stuff[0] in ('^', '['):
+                        stuff = '\\' + stuff
+                    res.append(f"(?!/)[{stuff}]")
+        else:
+            res.append(re.escape(c))
+    return ''.join(res)
+
+
+def compile_glob(glob: str) -> Optional[Pattern]:
+    """Translate a glob into a regex which searches the posix form of a path like Path.match(glob) does,
+    i.e. the glob's segments match the path's last segments and a wildcard doesn't match a slash.
+    It's equivalent only for a path with at least as many names as the glob has segments - see find_matching_glob.
+    Return None for an anchored glob, e.g. '/My Music/*', which is left to Path.match()
+    """
+    pure_glob = PurePath(glob)
+    if pure_glob.anchor:
+        return None
+    if not pure_glob.parts:
+        raise ValueError('empty pattern')
+    return re.compile(f"{GLOB_FLAGS}(?:^|/){SLASH.join(translate_glob_segment(part) for part in pure_glob.parts)}\\Z")
+
+
+def compile_globs(globs: Iterable[str]) -> CompiledGlobs:
+    """Return the globs mapped to their regexes, the regexes combined to rule out a path with a single search
+    (None if there's an anchored glob among them), and the largest number of segments in a glob"""
+    glob_to_rx = {glob: compile_glob(glob) for glob in globs}
+    rxs = list(glob_to_rx.values())
+    any_of_globs = compile_any_of_patterns(rxs) if None not in rxs else None
+    max_segments = max((len(PurePath(glob).parts) for glob in glob_to_rx), default=0)
+    return glob_to_rx, any_of_globs, max_segments
+
+
+def count_path_segments(path_psx: str) -> int:
+    """Return the number of names in a posix path, i.e. not counting its drive or root"""
+    names = os.path.splitdrive(path_psx)[1].lstrip(SLASH)
+    return names.count(SLASH) + 1 if names else 0
+
+
+def find_matching_glob(path_psx: str, compiled_globs: CompiledGlobs) -> Optional[str]:
+    """Return the first glob which the path matches, as in Path.match(glob).
+    The regexes are used only when each glob has at most as many segments as the path has names.
+    Otherwise, a glob's first segment is compared to the path's drive or root, which Path.match() handles
+    differently in different versions of Python, so Path.match() is called instead
+    """
+    glob_to_rx, any_of_globs, max_segments = compiled_globs
+    if max_segments > count_path_segments(path_psx):
+        pure_path = PurePath(path_psx)
+        for glob in glob_to_rx:
+            if pure_path.match(glob):
+                return glob
+        return None
+    if any_of_globs and not any_of_globs.search(path_psx):
+        return None
+    for glob, rx in glob_to_rx.items():
+        if rx.search(path_psx) if rx else PurePath(path_psx).match(glob):
+            return glob
+    return None
+
+
 def sorted_files_by_stem_then_suffix_ignoring_case(matching_files: Iterable[Path]):
     """sort by stem then suffix, i.e. 'abc.txt' before 'abc(2).txt'; ignore case"""
     return sorted(matching_files, key=lambda x: (x.stem.lower(), x.suffix.lower()))
@@ -712,26 +962,29 @@ class Rumar:
     COMMA = ','
     T = 'T'
     UNDERSCORE = '_'
+    MTIME_STR_TRANSLATION = str.maketrans({COLON: COMMA, T: UNDERSCORE})
     DOT_TAR = '.tar'
+    DOT_TAR_ZST = '.tar.zst'
     DOT_ZIPX = '.zipx'
     SYMLINK_COMPRESSLEVEL = 3
     COMPRESSLEVEL = 'compresslevel'
     COMPRESSION = 'compression'
     PRESET = 'preset'
+    LEVEL = 'level'
     SYMLINK_FORMAT_COMPRESSLEVEL = RumarFormat.TGZ, {COMPRESSLEVEL: SYMLINK_COMPRESSLEVEL}
     NOCOMPRESSION_FORMAT_COMPRESSLEVEL = RumarFormat.TAR, {}
     LNK = 'LNK'
     ARCHIVE_FORMAT_TO_MODE = {RumarFormat.TAR: 'x', RumarFormat.TGZ: 'x:gz', RumarFormat.TBZ: 'x:bz2', RumarFormat.TXZ: 'x:xz'}
-    RX_ARCHIVE_SUFFIX = re.compile(r'(\.(?:tar(?:\.(?:gz|bz2|xz))?|zipx))$')
-    CHECKSUM_SUFFIX = '.b2'
+    RX_ARCHIVE_SUFFIX = re.compile(r'(\.(?:tar(?:\.(?:gz|bz2|xz|zst))?|zipx))$')
+    CHECKSUM_ALGORITHM_TO_SUFFIX = {ChecksumAlgorithm.BLAKE2B: '.b2', ChecksumAlgorithm.XXH3: '.xxh3'}
+    CHECKSUM_SUFFIXES = tuple(CHECKSUM_ALGORITHM_TO_SUFFIX.values())
     CHECKSUM_SIZE_THRESHOLD = 10_000_000
-    STEMS = 'stems'
-    PATHS = 'paths'
+    WRITE_BUFFER_SIZE = 1 << 20
 
     def __init__(self, profile_to_settings: ProfileToSettings):
         self._profile_to_settings = profile_to_settings
         self._profile: Optional[str] = None
-        self._suffix_size_stems_and_paths: dict[str, dict[int, dict]] = {}
+        self._suffix_size_to_stem_to_path: dict[tuple[str, int], dict[str, Path]] = {}
         self._path_to_lstat: dict[Path, os.stat_result] = {}
         self._warnings = []
         self._errors = []
@@ -743,24 +996,45 @@ class Rumar:
 
     @staticmethod
     def find_last_file_in_dir(archive_dir: Path, pattern: Pattern = None) -> Optional[os.DirEntry]:
-        for dir_entry in sorted(os.scandir(archive_dir), key=lambda x: x.name, reverse=True):
-            if dir_entry.is_file():
-                if pattern is None or pattern.search(dir_entry.name):
-                    return dir_entry
+        """the file with the greatest name, i.e. the latest archive; one pass, no sorting"""
+        last_dir_entry = None
+        with os.scandir(archive_dir) as dir_entries:
+            for dir_entry in dir_entries:
+                if last_dir_entry is None or dir_entry.name > last_dir_entry.name:
+                    if dir_entry.is_file():
+                        if pattern is None or pattern.search(dir_entry.name):
+                            last_dir_entry = dir_entry
+        return last_dir_entry
 
     @staticmethod
-    def compute_checksum_of_file_in_archive(archive: Path, password: bytes) -> str:
+    def compute_checksum_of_file_in_archive(archive: Path, password: bytes, algorithm: ChecksumAlgorithm) -> str:
         if archive.suffix == Rumar.DOT_ZIPX:
             with pyzipper.AESZipFile(archive) as zf:
                 zf.setpassword(password)
                 zip_info = zf.infolist()[0]
                 with zf.open(zip_info) as f:
-                    return compute_blake2b_checksum(f)
+                    return compute_checksum(f, algorithm)
         else:
-            with tarfile.open(archive) as tf:
-                member = tf.getmembers()[0]
+            with Rumar.open_tar(archive) as tf:
+                member = tf.next()
                 with tf.extractfile(member) as f:
-                    return compute_blake2b_checksum(f)
+                    return compute_checksum(f, algorithm)
+
+    @staticmethod
+    @contextmanager
+    def open_tar(archive: Path) -> Iterator[tarfile.TarFile]:
+        """Open a tar archive for reading as a stream, i.e. members must be accessed in order, e.g. with next().
+        An archive contains one file, so there's no need to seek, and reading the first member
+        doesn't require scanning (decompressing) the archive to its end, which getmembers() would do.
+        The compression is detected from the stream, except for tar.zst, which is handled by zstandard.
+        """
+        if archive.name.endswith(Rumar.DOT_TAR_ZST):
+            with archive.open('rb') as f, zstandard.ZstdDecompressor().stream_reader(f) as zf:
+                with tarfile.open(fileobj=zf, mode='r|') as tf:
+                    yield tf
+        else:
+            with tarfile.open(archive, mode='r|*') as tf:
+                yield tf
 
     @staticmethod
     def set_mtime(target_path: Path, mtime: datetime):
@@ -772,18 +1046,22 @@ class Rumar:
     @classmethod
     def to_mtime_str(cls, dt: datetime) -> str:
         """archive-file stem - first part"""
-        if dt.utcoffset() is None:
-            dt = dt.astimezone()
-        return dt.astimezone().isoformat().replace(cls.COLON, cls.COMMA).replace(cls.T, cls.UNDERSCORE)
+        # astimezone() makes a naive dt aware, and converts an aware dt, to the local timezone
+        return dt.astimezone().isoformat().translate(cls.MTIME_STR_TRANSLATION)
 
     @classmethod
     def from_mtime_str(cls, s: str) -> datetime:
         return datetime.fromisoformat(s.replace(cls.UNDERSCORE, cls.T).replace(cls.COMMA, cls.COLON))
 
     @classmethod
-    def calc_checksum_file_path(cls, archive_path: Path) -> Path:
+    def calc_checksum_file_path(cls, archive_path: Path, algorithm: ChecksumAlgorithm) -> Path:
         core = cls.extract_core(archive_path.name)
-        return archive_path.with_name(f"{core}{cls.CHECKSUM_SUFFIX}")
+        return archive_path.with_name(f"{core}{cls.CHECKSUM_ALGORITHM_TO_SUFFIX[algorithm]}")
+
+    @classmethod
+    def calc_current_checksum_file_path(cls, archive_dir: Path, mtime_str: str, size: int, algorithm: ChecksumAlgorithm) -> Path:
+        """checksum file of the current (source) file, named after its mtime and size"""
+        return archive_dir / f"{mtime_str}{cls.MTIME_SEP}{size}{cls.CHECKSUM_ALGORITHM_TO_SUFFIX[algorithm]}"
 
     @classmethod
     def extract_mtime_size(cls, archive_path: Optional[Path]) -> Optional[tuple[str, int]]:
@@ -825,7 +1103,12 @@ class Rumar:
         return self._profile_to_settings[self._profile]
 
     def cached_lstat(self, path: Path):
-        return self._path_to_lstat.setdefault(path, path.lstat())
+        # not setdefault(path, path.lstat()), which would call lstat even when the result is cached
+        try:
+            return self._path_to_lstat[path]
+        except KeyError:
+            lstat = self._path_to_lstat[path] = path.lstat()
+            return lstat
 
     def create_for_all_profiles(self):
         for profile in self._profile_to_settings:
@@ -843,48 +1126,79 @@ class Rumar:
         if errors:
             logger.warning(f"SKIP {profile} - {'; '.join(errors)}")
             return
-        for p in self.source_files:
-            relative_p = make_relative_p(p, self.s.source_dir)
-            lstat = self.cached_lstat(p)  # don't follow symlinks - pathlib calls stat for each is_*()
-            mtime = lstat.st_mtime
-            mtime_dt = datetime.fromtimestamp(mtime).astimezone()
-            mtime_str = self.to_mtime_str(mtime_dt)
-            size = lstat.st_size
-            latest_archive = self._find_latest_archive(relative_p)
-            latest = self.extract_mtime_size(latest_archive)
-            archive_dir = self.calc_archive_container_dir(relative_p=relative_p)
-            if latest is None:
-                # no previous backup found
-                self._create(CreateReason.NEW, p, relative_p, archive_dir, mtime_str, size)
-            else:
-                latest_mtime_str, latest_size = latest
-                latest_mtime_dt = self.from_mtime_str(latest_mtime_str)
-                is_changed = False
-                if mtime_dt > latest_mtime_dt:
-                    if size != latest_size:
-                        is_changed = True
-                    else:
-                        is_changed = False
-                        if self.s.checksum_comparison_if_same_size:
-                            # get checksum of the latest archived file (unpacked)
-                            checksum_file = self.calc_checksum_file_path(latest_archive)
-                            if not checksum_file.exists():
-                                latest_checksum = self.compute_checksum_of_file_in_archive(latest_archive, self.s.password)
-                                logger.info(f':- {relative_p}  {latest_mtime_str}  {latest_checksum}')
-                                checksum_file.write_text(latest_checksum)
-                            else:
-                                latest_checksum = checksum_file.read_text()
-                            # get checksum of the current file
+        source_dir_psx = self.s.source_dir.as_posix()
+        if self.s.max_workers_for_create == 1:
+            for p in self.source_files:
+                self._create_for_file(p, source_dir_psx)
+        else:
+            self._create_for_files_concurrently(self.source_files, source_dir_psx)
+        self._at_end()
+
+    def _create_for_files_concurrently(self, paths: Iterable[Path], source_dir_psx: str):
+        """Archives files in a thread pool, with at most twice as many files submitted as there are workers.
+        The first exception, in the order of submission, cancels the files not yet started and is re-raised
+        """
+        max_pending = self.s.max_workers_for_create * 2
+        futures = deque()
+        with ThreadPoolExecutor(max_workers=self.s.max_workers_for_create) as executor:
+            try:
+                for p in paths:
+                    if len(futures) >= max_pending:
+                        futures.popleft().result()
+                    futures.append(executor.submit(self._create_for_file, p, source_dir_psx))
+                while futures:
+                    futures.popleft().result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _create_for_file(self, p: Path, source_dir_psx: str):
+        relative_p = make_relative_p(p, source_dir_psx)
+        lstat = self.cached_lstat(p)  # don't follow symlinks - pathlib calls stat for each is_*()
+        mtime = lstat.st_mtime
+        mtime_dt = datetime.fromtimestamp(mtime).astimezone()
+        mtime_str = self.to_mtime_str(mtime_dt)
+        size = lstat.st_size
+        archive_dir = self.calc_archive_container_dir(relative_p=relative_p)
+        latest_archive = self._find_latest_archive(archive_dir)
+        latest = self.extract_mtime_size(latest_archive)
+        if latest is None:
+            # no previous backup found
+            self._create(CreateReason.NEW, p, relative_p, archive_dir, mtime_str, size)
+        else:
+            latest_mtime_str, latest_size = latest
+            latest_mtime_dt = self.from_mtime_str(latest_mtime_str)
+            is_changed = False
+            checksum = None
+            if mtime_dt > latest_mtime_dt:
+                if size != latest_size:
+                    is_changed = True
+                else:
+                    is_changed = False
+                    if self.s.checksum_comparison_if_same_size:
+                        # get checksum of the latest archived file (unpacked)
+                        checksum_file = self.calc_checksum_file_path(latest_archive, self.s.checksum_algorithm)
+                        if not checksum_file.exists():
+                            latest_checksum = self.compute_checksum_of_file_in_archive(latest_archive, self.s.password, self.s.checksum_algorithm)
+                            logger.info(f':- {relative_p}  {latest_mtime_str}  {latest_checksum}')
+                            checksum_file.write_text(latest_checksum)
+                        else:
+                            latest_checksum = checksum_file.read_text()
+                        # get checksum of the current file - unless saved by a previous run (big file, same mtime and size)
+                        current_checksum_file = self.calc_current_checksum_file_path(archive_dir, mtime_str, size, self.s.checksum_algorithm)
+                        if size > self.CHECKSUM_SIZE_THRESHOLD and current_checksum_file.exists():
+                            checksum = current_checksum_file.read_text()
+                        else:
                             with p.open('rb') as f:
-                                checksum = compute_blake2b_checksum(f)
+                                checksum = compute_checksum(f, self.s.checksum_algorithm)
                             self._save_checksum_if_big(size, checksum, relative_p, archive_dir, mtime_str)
-                            is_changed = checksum != latest_checksum
-                        # else:  # newer mtime, same size, not instructed to do checksum comparison => no backup
-                if is_changed:
-                    # file has changed as compared to the last backup
-                    logger.info(f":= {relative_p}  {latest_mtime_str}  {latest_size} =: last backup")
-                    self._create(CreateReason.CHANGED, p, relative_p, archive_dir, mtime_str, size)
-        self._at_end()
+                        is_changed = checksum != latest_checksum
+                    # else:  # newer mtime, same size, not instructed to do checksum comparison => no backup
+            if is_changed:
+                # file has changed as compared to the last backup
+                logger.info(f":= {relative_p}  {latest_mtime_str}  {latest_size} =: last backup")
+                self._create(CreateReason.CHANGED, p, relative_p, archive_dir, mtime_str, size, checksum)
 
     def _at_beginning(self, profile: str):
         self._profile = profile  # for self.s to work
@@ -923,34 +1237,62 @@ class Rumar:
          |   10 MB | 0.05 | 0.02 |
         """
         if size > self.CHECKSUM_SIZE_THRESHOLD:
-            checksum_file = archive_dir / f"{mtime_str}{self.MTIME_SEP}{size}{self.CHECKSUM_SUFFIX}"
+            checksum_file = self.calc_current_checksum_file_path(archive_dir, mtime_str, size, self.s.checksum_algorithm)
             logger.info(f':  {relative_p}  {checksum}')
             archive_dir.mkdir(parents=True, exist_ok=True)
             checksum_file.write_text(checksum)
 
-    def _find_latest_archive(self, relative_p: str) -> Optional[Path]:
-        archive_dir = self.calc_archive_container_dir(relative_p=relative_p)
-        if not archive_dir.exists():
+    def _find_latest_archive(self, archive_dir: Path) -> Optional[Path]:
+        try:
+            latest_dir_entry = self.find_last_file_in_dir(archive_dir, self.RX_ARCHIVE_SUFFIX)
+        except FileNotFoundError:  # no previous backup
             return None
-        latest_dir_entry = self.find_last_file_in_dir(archive_dir, self.RX_ARCHIVE_SUFFIX)
         return Path(latest_dir_entry) if latest_dir_entry else None
 
-    def _create(self, create_reason: CreateReason, path: Path, relative_p: str, archive_dir: Path, mtime_str: str, size: int):
+    def _create(self, create_reason: CreateReason, path: Path, relative_p: str, archive_dir: Path, mtime_str: str, size: int, checksum: Optional[str] = None):
         if self.s.archive_format == RumarFormat.ZIPX:
             self._create_zipx(create_reason, path, relative_p, archive_dir, mtime_str, size)
         else:
-            self._create_tar(create_reason, path, relative_p, archive_dir, mtime_str, size)
+            self._create_tar(create_reason, path, relative_p, archive_dir, mtime_str, size, checksum)
 
-    def _create_tar(self, create_reason: CreateReason, path: Path, relative_p: str, archive_dir: Path, mtime_str: str, size: int):
+    def _create_tar(self, create_reason: CreateReason, path: Path, relative_p: str, archive_dir: Path, mtime_str: str, size: int, checksum: Optional[str] = None):
         archive_dir.mkdir(parents=True, exist_ok=True)
         sign = create_reason.value
         logger.info(f"{sign} {relative_p}  {mtime_str}  {size} {sign} {archive_dir}")
         archive_format, compresslevel_kwargs = self.calc_archive_format_and_compresslevel_kwargs(path)
-        mode = self.ARCHIVE_FORMAT_TO_MODE[archive_format]
         is_lnk = stat.S_ISLNK(self.cached_lstat(path).st_mode)
         archive_path = self.calc_archive_path(archive_dir, archive_format, mtime_str, size, self.LNK if is_lnk else self.BLANK)
-        with tarfile.open(archive_path, mode, format=self.s.tar_format, **compresslevel_kwargs) as tf:
+        # the checksum of the archived file will be needed to compare the file's next version, if of the same size;
+        # calculate it while the file is being archived - unless already known - rather than decompress the archive later
+        checksum_hash = None
+        if self.s.checksum_comparison_if_same_size and checksum is None and not is_lnk:
+            checksum_hash = new_checksum_hash(self.s.checksum_algorithm)
+        if archive_format == RumarFormat.TZST:
+            # single-threaded, like the other formats - concurrency comes from max_workers_for_create
+            cctx = zstandard.ZstdCompressor(**compresslevel_kwargs)
+            with archive_path.open('xb', buffering=self.WRITE_BUFFER_SIZE) as f, cctx.stream_writer(f) as zf:
+                with tarfile.open(fileobj=zf, mode='w|', format=self.s.tar_format, copybufsize=self.WRITE_BUFFER_SIZE) as tf:
+                    self._add_to_tar(tf, path, checksum_hash)
+        else:
+            mode = self.ARCHIVE_FORMAT_TO_MODE[archive_format]
+            # a big buffer coalesces the many small writes of tar blocks/compressed chunks into fewer syscalls
+            with archive_path.open('xb', buffering=self.WRITE_BUFFER_SIZE) as f:
+                with tarfile.open(fileobj=f, mode=mode, format=self.s.tar_format, copybufsize=self.WRITE_BUFFER_SIZE, **compresslevel_kwargs) as tf:
+                    self._add_to_tar(tf, path, checksum_hash)
+        if checksum_hash:
+            checksum = checksum_hash.hexdigest()
+        if checksum and not is_lnk:
+            self.calc_checksum_file_path(archive_path, self.s.checksum_algorithm).write_text(checksum)
+
+    @staticmethod
+    def _add_to_tar(tf: tarfile.TarFile, path: Path, checksum_hash=None):
+        """Like tf.add, but the file's data is also fed to checksum_hash, if given"""
+        if checksum_hash is None:
             tf.add(path, arcname=path.name)
+        else:
+            tarinfo = tf.gettarinfo(path, arcname=path.name)
+            with path.open('rb') as f:
+                tf.addfile(tarinfo, ChecksumReader(f, checksum_hash))
 
     def _create_zipx(self, create_reason: CreateReason, path: Path, relative_p: str, archive_dir: Path, mtime_str: str, size: int):
         archive_dir.mkdir(parents=True, exist_ok=True)
@@ -981,7 +1323,12 @@ class Rumar:
         elif path.suffix.lower() in self.s.suffixes_without_compression or self.s.archive_format == RumarFormat.TAR:
             return self.NOCOMPRESSION_FORMAT_COMPRESSLEVEL
         else:
-            key = self.PRESET if self.s.archive_format == RumarFormat.TXZ else self.COMPRESSLEVEL
+            if self.s.archive_format == RumarFormat.TXZ:
+                key = self.PRESET
+            elif self.s.archive_format == RumarFormat.TZST:
+                key = self.LEVEL
+            else:
+                key = self.COMPRESSLEVEL
             return self.s.archive_format, {key: self.s.compression_level}
 
     @property
@@ -1014,17 +1361,16 @@ class Rumar:
         """
         stem, suffix = os.path.splitext(file_path.name.lower())
         size = self.cached_lstat(file_path).st_size
-        if size_to_stems_and_paths := self._suffix_size_stems_and_paths.get(suffix):
-            if stems_and_paths := size_to_stems_and_paths.get(size):
-                if stems_and_paths:
-                    stems = stems_and_paths[self.STEMS]
-                    for index, s in enumerate(stems):
-                        if stem in s or s in stem:
-                            return stems_and_paths[self.PATHS][index]
+        stem_to_path = self._suffix_size_to_stem_to_path.setdefault((suffix, size), {})
+        # a stem is recorded only if it's not a part of any recorded stem, nor any recorded stem is a part of it,
+        # so an exact match is the only match - no need to look further
+        if path := stem_to_path.get(stem):
+            return path
+        for s, path in stem_to_path.items():
+            if stem in s or s in stem:
+                return path
         # no record; create one
-        stems_and_paths = self._suffix_size_stems_and_paths.setdefault(suffix, {}).setdefault(size, {})
-        stems_and_paths.setdefault(self.STEMS, []).append(stem)
-        stems_and_paths.setdefault(self.PATHS, []).append(file_path)
+        stem_to_path[stem] = file_path
 
     def extract_for_all_profiles(self, archive_dir: Optional[Path], directory: Optional[Path], overwrite: bool, meta_diff: bool):
         for profile in self._profile_to_settings:
@@ -1131,8 +1477,8 @@ class Rumar:
 
     def _extract_tar(self, archive_file: Path, target_file: Path):
         logger.info(f":@ {archive_file.parent.name} | {archive_file.name} -> {target_file}")
-        with tarfile.open(archive_file) as tf:
-            member = cast(tarfile.TarInfo, tf.getmembers()[0])
+        with self.open_tar(archive_file) as tf:
+            member = cast(tarfile.TarInfo, tf.next())
             if member.name == target_file.name:
                 if (vi.major, vi.minor) >= (3, 12):
                     tf.extract(member, target_file.parent, filter='tar')
@@ -1153,7 +1499,30 @@ def try_to_iterate_dir(path: Path):
     return None
 
 
-def compute_blake2b_checksum(f: BufferedIOBase) -> str:
+CHECKSUM_CHUNK_SIZE = 1 << 20
+
+
+def new_checksum_hash(algorithm: ChecksumAlgorithm):
+    if algorithm == ChecksumAlgorithm.XXH3:
+        return xxhash.xxh3_128()
+    else:
+        return blake2b(usedforsecurity=False)  # change detection, not security
+
+
+class ChecksumReader:
+    """Wraps a file opened for reading, updating the checksum hash with the data as it's read, e.g. by tarfile"""
+
+    def __init__(self, f: BufferedIOBase, checksum_hash):
+        self._f = f
+        self._checksum_hash = checksum_hash
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._f.read(size)
+        self._checksum_hash.update(data)
+        return data
+
+
+def compute_checksum(f: BufferedIOBase, algorithm: ChecksumAlgorithm = ChecksumAlgorithm.BLAKE2B) -> str:
     # https://docs.python.org/3/library/functions.html#open
     # The type of file object returned by the open() function depends on the mode.
     # When used to open a file in a binary mode with buffering, the returned class is a subclass of io.BufferedIOBase.
@@ -1161,34 +1530,31 @@ def compute_blake2b_checksum(f: BufferedIOBase) -> str:
     # https://docs.python.org/3/library/io.html#io.BufferedIOBase
     # BufferedIOBase: [read(), readinto() and write(),] unlike their RawIOBase counterparts, [...] will never return None.
     # read(): An empty bytes object is returned if the stream is already at EOF.
-    b = blake2b()
-    for chunk in iter(lambda: f.read(32768), b''):
-        b.update(chunk)
-    return b.hexdigest()
+    # readinto() a preallocated buffer, to avoid creating a new bytes object for each chunk
+    h = new_checksum_hash(algorithm)
+    buffer = bytearray(CHECKSUM_CHUNK_SIZE)
+    view = memoryview(buffer)
+    while n := f.readinto(buffer):
+        h.update(view[:n])
+    return h.hexdigest()
 
 
 class Broom:
-    DASH = '-'
-    DOT = '.'
 
     def __init__(self, profile_to_settings: ProfileToSettings):
         self._profile_to_settings = profile_to_settings
         self._db = BroomDB()
 
-    @classmethod
-    def is_archive(cls, name: str, archive_format: str) -> bool:
-        return (name.endswith(cls.DOT + archive_format) or
-                name.endswith(cls.DOT + RumarFormat.TAR.value))
+    @staticmethod
+    def compile_archive_rx(archive_format: str) -> Pattern:
+        """Matches the name of an archive in archive_format or in tar (used instead when no compression is needed),
+        capturing the date the name starts with, e.g. 2023-04-30 in 2023-04-30_09,48,20.872144+02,00~123.tar.gz
+        """
+        return re.compile(rf'([0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}}).*\.(?:{re.escape(archive_format)}|{RumarFormat.TAR.value})', re.DOTALL)
 
     @staticmethod
     def is_checksum(name: str) -> bool:
-        return name.endswith(Rumar.CHECKSUM_SUFFIX)
-
-    @classmethod
-    def extract_date_from_name(cls, name: str) -> date:
-        iso_date_string = name[:10]
-        y, m, d = iso_date_string.split(cls.DASH)
-        return date(int(y), int(m), int(d))
+        return name.endswith(Rumar.CHECKSUM_SUFFIXES)
 
     def sweep_all_profiles(self, *, is_dry_run: bool):
         for profile in self._profile_to_settings:
@@ -1214,16 +1580,16 @@ class Broom:
             iterator = iter_all_files(s.backup_base_dir_for_profile)
             logger.debug(f"{s.commands_which_use_filters=} => iter_all_files")
         old_enough_file_to_mdate = {}
+        archive_rx = self.compile_archive_rx(archive_format)
         for path in iterator:
-            if self.is_archive(path.name, archive_format):
-                mdate = self.extract_date_from_name(path.name)
+            if m := archive_rx.fullmatch(path.name):
+                mdate = date.fromisoformat(m.group(1))
                 if mdate <= date_older_than_x_days:
                     old_enough_file_to_mdate[path] = mdate
             elif not self.is_checksum(path.name):
                 logger.warning(f":! {path.as_posix()}  is unexpected (not an archive)")
-        for path in sorted_files_by_stem_then_suffix_ignoring_case(old_enough_file_to_mdate):
-            self._db.insert(path, mdate=old_enough_file_to_mdate[path])
-        self._db.commit()
+        self._db.insert_many((path, old_enough_file_to_mdate[path])
+                             for path in sorted_files_by_stem_then_suffix_ignoring_case(old_enough_file_to_mdate))
         self._db.update_counts(s)
 
     def delete_files(self, is_dry_run):
@@ -1234,226 +1600,238 @@ class Broom:
             logger.info(f"-- {path.as_posix()}  {rm_action_info} because it's #{m_rm} in month {m}, #{w_rm} in week {w}, #{d_rm} in day {d}")
             if not is_dry_run:
                 path.unlink()
+                # the archive's checksum file, if any, is of no use without the archive
+                core = Rumar.extract_core(basename)
+                for checksum_suffix in Rumar.CHECKSUM_SUFFIXES:
+                    path.with_name(f"{core}{checksum_suffix}").unlink(missing_ok=True)
 
 
 class BroomDB:
-    DATABASE = me.with_suffix('.sqlite') if logger.level <= logging.DEBUG else ':memory:'
+    """
+    Scratch database used by a single sweep to count backups per day/week/month and mark those to be removed.
+    It's in memory, unless the log level is DEBUG, when it's kept in rumar.sqlite next to the program, for inspection.
+    Each sweep creates its own table and nothing is read back by later runs,
+    therefore durability is traded for speed (journal in memory or WAL, reduced fsync).
+    """
+    MEMORY = ':memory:'
+    DATABASE = me.with_suffix('.sqlite') if logger.level <= logging.DEBUG else MEMORY
     TABLE_PREFIX = 'broom'
     TABLE_DT_FRMT = '_%Y%m%d_%H%M%S'
+    MARKED_SUFFIX = '_marked'
     DATE_FORMAT = '%Y-%m-%d'
-    WEEK_FORMAT = '%Y-%W'  # Monday as the first day of the week, zero-padded
-    WEEK_ONLY_FORMAT = '%W'
-    MONTH_FORMAT = '%Y-%m'
+    YEAR_NUM_FORMAT = '{}-{:02d}'  # week or month, as in %Y-%W or %Y-%m
     DUNDER = '__'
+    PRAGMAS = ('temp_store=MEMORY', 'cache_size=-65536', 'mmap_size=268435456')
+    FETCH_SIZE = 1000
+    # SQL templates, formatted with the table name once per instance
+    CREATE_TABLE_SQL = dedent("""\
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY,
+            dirname TEXT NOT NULL,
+            basename TEXT NOT NULL,
+            d INTEGER NOT NULL,
+            w INTEGER NOT NULL,
+            m INTEGER NOT NULL,
+            d_rm TEXT,
+            w_rm TEXT,
+            m_rm TEXT
+        )
+        """)
+    INSERT_SQL = "INSERT INTO {table} (dirname, basename, d, w, m) VALUES (?,?,?,?,?)"
+    # dd: all rows in a day are either in or out, hence the max d_num marked is d_cnt - d_keep
+    # ww, mm: rows marked are the first ones in a partition, hence the max num marked is min(sel, cnt - keep)
+    # marked rows are collected in a temporary table and copied by id, rather than with UPDATE ... FROM,
+    # which would require SQLite 3.33, while window functions require 3.25
+    CREATE_MARKED_TABLE_SQL = "CREATE TEMP TABLE {marked} (id INTEGER PRIMARY KEY, d_rm TEXT, w_rm TEXT, m_rm TEXT)"
+    MARK_RM_SQL = dedent("""\
+        INSERT INTO {marked} (id, d_rm, w_rm, m_rm)
+        WITH br AS (
+            SELECT id, dirname, d, w, m, d_rm, w_rm,
+                row_number() OVER (PARTITION BY dirname, d ORDER BY id) AS d_num,
+                count(*) OVER (PARTITION BY dirname, d) AS d_cnt,
+                count(*) OVER (PARTITION BY dirname, w) AS w_cnt,
+                count(*) OVER (PARTITION BY dirname, m) AS m_cnt
+            FROM {table}
+        ), dd AS (
+            SELECT *, m_cnt > :m_keep AND w_cnt > :w_keep AND d_num <= d_cnt - :d_keep AS is_d_rm
+            FROM br
+        ), ww AS (
+            SELECT id, dirname, m, w_rm, w_cnt, m_cnt,
+                row_number() OVER (PARTITION BY dirname, w ORDER BY id) AS w_num,
+                count(*) OVER (PARTITION BY dirname, w) AS w_sel
+            FROM dd
+            WHERE is_d_rm OR d_rm IS NOT NULL
+        ), mm AS (
+            SELECT id, m_cnt,
+                row_number() OVER (PARTITION BY dirname, m ORDER BY id) AS m_num,
+                count(*) OVER (PARTITION BY dirname, m) AS m_sel
+            FROM ww
+            WHERE w_num <= w_cnt - :w_keep OR w_rm IS NOT NULL
+        ), marked AS (
+            SELECT dd.id,
+                CASE WHEN dd.is_d_rm
+                    THEN printf('%d of %d (max %d - %d)', dd.d_num, dd.d_cnt - :d_keep, dd.d_cnt, :d_keep)
+                END AS d_rm,
+                CASE WHEN ww.w_num <= ww.w_cnt - :w_keep
+                    THEN printf('%d of %d (max %d - %d)', ww.w_num, min(ww.w_sel, ww.w_cnt - :w_keep), ww.w_cnt, :w_keep)
+                END AS w_rm,
+                CASE WHEN mm.m_num <= mm.m_cnt - :m_keep
+                    THEN printf('%d of %d (max %d - %d)', mm.m_num, min(mm.m_sel, mm.m_cnt - :m_keep), mm.m_cnt, :m_keep)
+                END AS m_rm
+            FROM dd
+            LEFT JOIN ww ON ww.id = dd.id
+            LEFT JOIN mm ON mm.id = dd.id
+            WHERE dd.is_d_rm OR ww.w_num <= ww.w_cnt - :w_keep OR mm.m_num <= mm.m_cnt - :m_keep
+        )
+        SELECT id, d_rm, w_rm, m_rm FROM marked
+        """)
+    UPDATE_RM_SQL = dedent("""\
+        UPDATE {table}
+        SET (d_rm, w_rm, m_rm) = (
+            SELECT coalesce(mk.d_rm, {table}.d_rm), coalesce(mk.w_rm, {table}.w_rm), coalesce(mk.m_rm, {table}.m_rm)
+            FROM {marked} AS mk
+            WHERE mk.id = {table}.id
+        )
+        WHERE id IN (SELECT id FROM {marked})
+        """)
+    DROP_MARKED_TABLE_SQL = "DROP TABLE {marked}"
+    SELECT_MARKED_SQL = dedent("""\
+        SELECT dirname, basename, d, w, m, d_rm, w_rm, m_rm
+        FROM {table}
+        WHERE m_rm IS NOT NULL
+        ORDER BY dirname, basename
+        """)
 
     def __init__(self):
-        self._db = sqlite3.connect(self.DATABASE)
+        # autocommit mode: transactions are opened explicitly with _begin, not implicitly by sqlite3
+        self._db = sqlite3.connect(self.DATABASE, isolation_level=None)
+        if logger.isEnabledFor(DEBUG_11):
+            self._db.set_trace_callback(self._log_sql)
+        self._set_pragmas()
         self._table = f"{self.TABLE_PREFIX}{datetime.now().strftime(self.TABLE_DT_FRMT)}"
         logger.debug(f"{self.DATABASE} | {self._table}")
         self._create_table_if_not_exists()
+        self._ins_stmt = self.INSERT_SQL.format(table=self._table)
+        marked = f"temp.{self._table}{self.MARKED_SUFFIX}"
+        self._crt_marked_stmt = self.CREATE_MARKED_TABLE_SQL.format(marked=marked)
+        self._mark_rm_stmt = self.MARK_RM_SQL.format(table=self._table, marked=marked)
+        self._upd_rm_stmt = self.UPDATE_RM_SQL.format(table=self._table, marked=marked)
+        self._drop_marked_stmt = self.DROP_MARKED_TABLE_SQL.format(marked=marked)
+        self._sel_marked_stmt = self.SELECT_MARKED_SQL.format(table=self._table)
+        self._ins_cur = self._db.cursor()
+
+    @staticmethod
+    def _log_sql(stmt: str):
+        """Log each SQL statement as executed by SQLite, i.e. with bound parameters expanded"""
+        logger.log(DEBUG_11, stmt)
+
+    @contextmanager
+    def _begin(self):
+        """Runs the statements inside the with-block in a single transaction; rolls it back on exception"""
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        else:
+            self._db.execute('COMMIT')
+
+    def _set_pragmas(self):
+        if self.DATABASE == self.MEMORY:
+            # WAL is not available for an in-memory database; there's nothing to sync either
+            journal_mode, synchronous = 'MEMORY', 'OFF'
+        else:
+            journal_mode, synchronous = 'WAL', 'NORMAL'
+        self._db.execute(f"PRAGMA journal_mode={journal_mode}")
+        self._db.execute(f"PRAGMA synchronous={synchronous}")
+        for pragma in self.PRAGMAS:
+            self._db.execute(f"PRAGMA {pragma}")
 
     @classmethod
-    def calc_week(cls, mdate: date) -> str:
+    @lru_cache(maxsize=4096)  # backups of the same day come one after another
+    def calc_week(cls, mdate: date) -> int:
         """
+        year * 100 + week number, with Monday as the first day of the week, i.e. as in %W;
         consider week 0 as previous year's last week
         """
-        m = mdate.month
-        d = mdate.day
-        if m == 1 and d < 7 and mdate.strftime(cls.WEEK_ONLY_FORMAT) == '00':
-            mdate = mdate.replace(day=1) - timedelta(days=1)
-        return mdate.strftime(cls.WEEK_FORMAT)
+        week = (mdate.timetuple().tm_yday + 6 - mdate.weekday()) // 7
+        if week == 0:
+            return cls.calc_week(date(mdate.year - 1, 12, 31))
+        return mdate.year * 100 + week
+
+    @staticmethod
+    def calc_month(mdate: date) -> int:
+        """year * 100 + month"""
+        return mdate.year * 100 + mdate.month
+
+    @classmethod
+    def format_day(cls, d: int) -> str:
+        return date.fromordinal(d).strftime(cls.DATE_FORMAT)
+
+    @classmethod
+    def format_year_num(cls, year_num: int) -> str:
+        return cls.YEAR_NUM_FORMAT.format(*divmod(year_num, 100))
 
     def _create_table_if_not_exists(self):
-        ddl = dedent(f"""\
-            CREATE TABLE IF NOT EXISTS {self._table} (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                dirname TEXT NOT NULL,
-                basename TEXT NOT NULL,
-                d TEXT NOT NULL,
-                w TEXT NOT NULL,
-                m TEXT NOT NULL,
-                d_rm TEXT,
-                w_rm TEXT,
-                m_rm TEXT
-            )
-            """)
-        self._db.execute(ddl)
+        self._db.execute(self.CREATE_TABLE_SQL.format(table=self._table))
 
     def _create_indexes_if_not_exist(self):
-        index_ddls = (f"CREATE INDEX IF NOT EXISTS idx_dirname_d ON {self._table} (dirname, d)",
-                      f"CREATE INDEX IF NOT EXISTS idx_dirname_w ON {self._table} (dirname, w)",
-                      f"CREATE INDEX IF NOT EXISTS idx_dirname_m ON {self._table} (dirname, m)")
+        # only the first window pass over the table can stream rows presorted by an index - the passes over
+        # the derived rows are sorted anyway, so indexes on (dirname, d) and (dirname, w) would only be built, never used;
+        # id is INTEGER PRIMARY KEY, i.e. the rowid, which every index carries, hence (dirname, m) sorts as (dirname, m, id)
+        index_ddls = (f"CREATE INDEX IF NOT EXISTS idx_dirname_m ON {self._table} (dirname, m)",)
         for ddl in index_ddls:
             self._db.execute(ddl)
 
-    def insert(self, path: Path, mdate: date, should_commit=False):
-        # logger.log(METHOD_17, f"{path.as_posix()}")
-        params = (
+    def _calc_insert_params(self, path: Path, mdate: date) -> tuple[str, str, int, int, int]:
+        return (
             path.parent.as_posix(),
             path.name,
-            mdate.strftime(self.DATE_FORMAT),
+            mdate.toordinal(),
             self.calc_week(mdate),
-            mdate.strftime(self.MONTH_FORMAT),
+            self.calc_month(mdate),
         )
-        ins_stmt = f"INSERT INTO {self._table} (dirname, basename, d, w, m) VALUES (?,?,?,?,?)"
-        self._db.execute(ins_stmt, params)
-        if should_commit:
-            self._db.commit()
 
-    def commit(self):
-        self._db.commit()
+    def insert_many(self, items: Iterable[tuple[Path, date]]):
+        """Inserts (path, mdate) items with a single executemany, in one transaction"""
+        with self._begin():
+            self._ins_cur.executemany(self._ins_stmt, (self._calc_insert_params(path, mdate) for path, mdate in items))
 
     def update_counts(self, s: Settings):
         self._create_indexes_if_not_exist()
-        self._update_d_rm(s)
-        self._update_w_rm(s)
-        self._update_m_rm(s)
-
-    def _update_d_rm(self, s: Settings):
-        """Sets d_rm, putting the information about 
-        backup-file number in a day to be removed,
-        maximal backup-file number in a day to be removed,
-        count of backups pef files in a day,
-        backups to keep per file in a day.
-        To find the files, the SQL query looks for 
-        months with the files count bigger than monthly backups to keep,
-        weeks with the files count bigger than weekly backups to keep,
-        days with the files count bigger than daily backups to keep.
-        """
-        stmt = dedent(f"""\
-        SELECT * FROM (
-            SELECT br.dirname, br.d, br.id, dd.cnt, row_number() OVER win1 AS num
-            FROM {self._table} br
-            JOIN (
-                SELECT dirname, m, count(*) cnt
-                FROM {self._table} 
-                GROUP BY dirname, m
-                HAVING count(*) > {s.number_of_backups_per_month_to_keep}
-            ) mm ON br.dirname = mm.dirname AND br.m = mm.m
-            JOIN (
-                SELECT dirname, w, count(*) cnt
-                FROM {self._table} 
-                GROUP BY dirname, w
-                HAVING count(*) > {s.number_of_backups_per_week_to_keep}
-            ) ww ON br.dirname = ww.dirname AND br.w = ww.w
-            JOIN (
-                SELECT dirname, d, count(*) cnt
-                FROM {self._table} 
-                GROUP BY dirname, d
-                HAVING count(*) > {s.number_of_backups_per_day_to_keep}
-            ) dd ON br.dirname = dd.dirname AND br.d = dd.d
-            WINDOW win1 AS (PARTITION BY br.dirname, br.d ORDER BY br.dirname, br.d, br.id)
-        )
-        WHERE num <= cnt - {s.number_of_backups_per_day_to_keep}
-        ORDER BY dirname, d, id
-        """)
-        db = self._db
-        rows = db.execute(stmt).fetchall()
-        cur = db.cursor()
-        for row in rows:
-            dirname, d, broom_id, cnt, num = row
-            max_num = max(row[4] for row in rows if row[0] == dirname and row[1] == d)
-            updt_stmt = dedent(f"""\
-                UPDATE {self._table}
-                SET d_rm = '{num} of {max_num} (max {cnt} - {s.number_of_backups_per_day_to_keep})'
-                WHERE id = ?
-                """)
-            cur.execute(updt_stmt, (broom_id,))
-        db.commit()
-
-    def _update_w_rm(self, s: Settings):
-        """Sets w_rm, putting the information about 
-        backup-file number in a week to be removed,
-        maximal backup-file number in a week to be removed,
-        count of all backups per file in a week,
-        backups to keep per file in a week.
+        self._update_rm(s)
+
+    def _update_rm(self, s: Settings):
+        """Sets d_rm, w_rm and m_rm in a single transaction, putting the information about
+        backup-file number in a day/week/month to be removed,
+        maximal backup-file number in a day/week/month to be removed,
+        count of all backups per file in a day/week/month,
+        backups to keep per file in a day/week/month.
         To find the files, the SQL query looks for
-        days marked for removal, calculated based on
-        months with the files count bigger than monthly backups to keep,
-        weeks with the files count bigger than weekly backups to keep,
-        days with the files count bigger than daily backups to keep.
+        days with the files count bigger than daily backups to keep,
+        in weeks and months with the files count bigger than weekly and monthly backups to keep (d_rm);
+        among days marked for removal, weeks with the files count bigger than weekly backups to keep (w_rm);
+        among weeks marked for removal, months with the files count bigger than monthly backups to keep (m_rm).
+        Rows marked by a previous run are taken into account, as if each level were updated one after another.
         """
-        stmt = dedent(f"""\
-        SELECT * FROM (
-            SELECT br.dirname, br.w, br.id, ww.cnt, row_number() OVER win1 AS num
-            FROM {self._table} br
-            JOIN (
-                SELECT dirname, w, count(*) cnt
-                FROM {self._table} 
-                GROUP BY dirname, w
-                HAVING count(*) > {s.number_of_backups_per_week_to_keep}
-            ) ww ON br.dirname = ww.dirname AND br.w = ww.w
-            WHERE br.d_rm IS NOT NULL
-            WINDOW win1 AS (PARTITION BY br.dirname, br.w ORDER BY br.dirname, br.w, br.id)
-        )
-        WHERE num <= cnt - {s.number_of_backups_per_week_to_keep}
-        ORDER BY dirname, w, id
-        """)
-        db = self._db
-        rows = db.execute(stmt).fetchall()
-        cur = db.cursor()
-        for row in rows:
-            dirname, w, broom_id, cnt, num = row
-            max_num = max(row[4] for row in rows if row[0] == dirname and row[1] == w)
-            updt_stmt = dedent(f"""\
-                UPDATE {self._table}
-                SET w_rm = '{num} of {max_num} (max {cnt} - {s.number_of_backups_per_week_to_keep})'
-                WHERE id = ?
-                """)
-            cur.execute(updt_stmt, (broom_id,))
-        db.commit()
-
-    def _update_m_rm(self, s: Settings):
-        """Sets m_rm, putting the information about 
-        backup-file number in a month to be removed,
-        maximal backup-file number in a month to be removed,
-        count of all backups per file in a month,
-        backups to keep per file in a month.
-        To find the files, the SQL query looks for 
-        weeks marked for removal, calculated based on
-        months with the files count bigger than monthly backups to keep,
-        weeks with the files count bigger than weekly backups to keep,
-        days with the files count bigger than daily backups to keep.
-        """
-        stmt = dedent(f"""\
-        SELECT * FROM (
-            SELECT br.dirname, br.m, br.id, mm.cnt, row_number() OVER win1 AS num
-            FROM {self._table} br
-            JOIN (
-                SELECT dirname, m, count(*) cnt
-                FROM {self._table} 
-                GROUP BY dirname, m
-                HAVING count(*) > {s.number_of_backups_per_month_to_keep}
-            ) mm ON br.dirname = mm.dirname AND br.m = mm.m
-            WHERE br.w_rm IS NOT NULL
-            WINDOW win1 AS (PARTITION BY br.dirname, br.m ORDER BY br.dirname, br.m, br.id)
-        )
-        WHERE num <= cnt - {s.number_of_backups_per_month_to_keep}
-        ORDER BY dirname, m, id
-        """)
-        db = self._db
-        rows = db.execute(stmt).fetchall()
-        cur = db.cursor()
-        for row in rows:
-            dirname, m, broom_id, cnt, num = row
-            max_num = max(row[4] for row in rows if row[0] == dirname and row[1] == m)
-            updt_stmt = dedent(f"""\
-                UPDATE {self._table}
-                SET m_rm = '{num} of {max_num} (max {cnt} - {s.number_of_backups_per_month_to_keep})'
-                WHERE id = ?
-                """)
-            cur.execute(updt_stmt, (broom_id,))
-        db.commit()
+        params = {
+            'd_keep': s.number_of_backups_per_day_to_keep,
+            'w_keep': s.number_of_backups_per_week_to_keep,
+            'm_keep': s.number_of_backups_per_month_to_keep,
+        }
+        with self._begin():
+            self._db.execute(self._crt_marked_stmt)
+            self._db.execute(self._mark_rm_stmt, params)
+            self._db.execute(self._upd_rm_stmt)
+            self._db.execute(self._drop_marked_stmt)
 
     def iter_marked_for_removal(self) -> Iterator[tuple[str, str, str, str, str, str, str, str]]:
-        stmt = dedent(f"""\
-            SELECT dirname, basename, d, w, m, d_rm, w_rm, m_rm
-            FROM {self._table}
-            WHERE m_rm IS NOT NULL
-            ORDER BY dirname, basename
-            """)
-        for row in self._db.execute(stmt):
-            yield row
+        cur = self._db.execute(self._sel_marked_stmt)
+        cur.arraysize = self.FETCH_SIZE
+        while rows := cur.fetchmany():
+            for dirname, basename, d, w, m, d_rm, w_rm, m_rm in rows:
+                yield dirname, basename, self.format_day(d), self.format_year_num(w), self.format_year_num(m), d_rm, w_rm, m_rm
 
 
 if __name__ == '__main__':
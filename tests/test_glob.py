@@ -0,0 +1,125 @@
+import os
+import random
+import sys
+import unittest
+from pathlib import Path, PurePath
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+from rumar import compile_glob, compile_globs, count_path_segments, find_matching_glob  # noqa: E402
+
+PATHS = [
+    '/b',
+    '/x/b',
+    '/x/b.txt',
+    '/a/x/b.txt',
+    '/a/x/B.TXT',
+    '/home/u/Docs/report.doc',
+    '/home/u/Docs/report (2).doc',
+    '/home/u/.hidden/[b]',
+    '/home/u/a-b/c!d',
+    'x/b',
+    'b',
+]
+GLOBS = [
+    '*',
+    'b',
+    '*.txt',
+    '*.TXT',
+    '*/b',
+    '*/x/b',
+    '*/*/x/b',
+    'x/*',
+    '*/x/*',
+    'a/*/b.txt',
+    '**/b',
+    '?',
+    '?/?',
+    '[ab]*',
+    '[!a]*',
+    '[a-c]*/*',
+    '[!a-c]',
+    '[[]b]',
+    '*[!.]doc',
+    'report ([0-9]).doc',
+    '.*/*',
+    'a-b/*!*',
+    '/x/*',
+    '/*/b',
+]
+
+
+def expected_glob(path: str, globs: list[str]):
+    return next((glob for glob in globs if PurePath(path).match(glob)), None)
+
+
+class TestFindMatchingGlob(unittest.TestCase):
+    """find_matching_glob must give the same answer as Path.match, in the Python version it runs on"""
+
+    def test_each_glob_is_like_path_match(self):
+        for path in PATHS:
+            for glob in GLOBS:
+                with self.subTest(path=path, glob=glob):
+                    self.assertEqual(expected_glob(path, [glob]), find_matching_glob(path, compile_globs([glob])))
+
+    def test_globs_together_are_like_path_match(self):
+        unanchored_globs = [glob for glob in GLOBS if not glob.startswith('/')]
+        for globs in [GLOBS, unanchored_globs, unanchored_globs[::-1]]:
+            compiled_globs = compile_globs(globs)
+            for path in PATHS:
+                with self.subTest(path=path, globs=globs):
+                    self.assertEqual(expected_glob(path, globs), find_matching_glob(path, compiled_globs))
+
+    def test_random_globs_are_like_path_match(self):
+        rnd = random.Random(0)
+        segment_chars = 'ab.x!'
+        glob_chars = segment_chars + '*?[]'
+
+        def random_segment(chars: str, max_len: int) -> str:
+            # '.' is dropped by PurePath, like a '.' in a path, and os.walk() doesn't yield it
+            while (segment := ''.join(rnd.choices(chars, k=rnd.randint(1, max_len)))) == '.':
+                pass
+            return segment
+
+        for _ in range(5000):
+            depth = rnd.randint(1, 4)
+            path = '/' + '/'.join(random_segment(segment_chars, 3) for _ in range(depth))
+            glob = '/'.join(random_segment(glob_chars, 4) for _ in range(rnd.randint(1, depth + 1)))
+            with self.subTest(path=path, glob=glob):
+                self.assertEqual(expected_glob(path, [glob]), find_matching_glob(path, compile_globs([glob])))
+
+    def test_no_globs(self):
+        self.assertIsNone(find_matching_glob('/x/b', compile_globs([])))
+
+
+class TestCompileGlob(unittest.TestCase):
+
+    def test_anchored_glob_is_left_to_path_match(self):
+        self.assertIsNone(compile_glob('/x/*'))
+
+    def test_empty_glob_is_rejected(self):
+        with self.assertRaises(ValueError):
+            compile_glob('')
+
+    def test_wildcards_do_not_match_a_slash(self):
+        for glob in ['x*b', 'x?b', 'x[!a]b', 'x[^/]b']:
+            with self.subTest(glob=glob):
+                self.assertIsNone(compile_glob(glob).search('/a/x/b'))
+
+
+class TestCountPathSegments(unittest.TestCase):
+
+    def test_posix(self):
+        self.assertEqual(2, count_path_segments('/x/b'))
+        self.assertEqual(2, count_path_segments('x/b'))
+        self.assertEqual(1, count_path_segments('/b'))
+        self.assertEqual(0, count_path_segments('/'))
+
+    @unittest.skipUnless(os.name == 'nt', 'drives exist on NT only')
+    def test_nt(self):
+        self.assertEqual(2, count_path_segments('C:/x/b'))
+        self.assertEqual(1, count_path_segments('//server/share/b'))
+
+
+if __name__ == '__main__':
+    unittest.main()